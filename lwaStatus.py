@@ -17,83 +17,54 @@ In addition, the station information is displayed on the running terminal.
 """
 
 
-import re
-import sys
-import json
 import time
+import queue
 import curses
-import string
-from urllib.request import urlopen
 import argparse
+import requests
+import email.utils
 import threading
 from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from blinkstick import blinkstick
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
-# RegEx for parsing out the DR OP-TYPE from the OpScreen page
-drRE = re.compile(r'\<tr\>\<td\>DR(?P<N>\d)\<\/td\>')
 
+# OpScreen SUMMARY value -> station status and DR OP_TYPE value -> OP-TYPE 
+# conversions
+summaryValues = {'ERROR': 0, 'WARNING': 1, 'SHUTDWN': 1}
+opTypeValues = {'Record': 2, 'Spectrometr': 1}
 
-# Template for the curses output
-display = {}
-
-display[2] = string.Template("""Overall Status of $station:
-$sysStatus
-
-Operation Types:
-  DR1: $optype1
-  DR2: $optype2
-
-LASI:
-  $lasiStatus
-
-Updated: $tUpdate UTC
-""")
-
-display[3] = string.Template("""Overall Status of $station:
-$sysStatus
-
-Operation Types:
-  DR1: $optype1
-  DR2: $optype2
-  DR3: $optype3
-
-LASI:
-  $lasiStatus
-
-Updated: $tUpdate UTC
-""")
 
-display[4] = string.Template("""Overall Status of $station:
-$sysStatus
+# Format strings for the curses output, one per number of DRs
+display = {}
+for _ndr in (2, 3, 4, 5):
+    _drLines = '\n'.join(['  DR%i: {optype%i}' % (i+1, i+1) for i in range(_ndr)])
+    display[_ndr] = """Overall Status of {station}:
+{sysStatus}
 
 Operation Types:
-  DR1: $optype1
-  DR2: $optype2
-  DR3: $optype3
-  DR4: $optype4
+%s
 
 LASI:
-  $lasiStatus
-
-Updated: $tUpdate UTC
-""")
+  {lasiStatus}
 
-display[5] = string.Template("""Overall Status of $station:
-$sysStatus
+Updated: {tUpdate} UTC
+""" % _drLines
+del _ndr, _drLines
 
-Operation Types:
-  DR1: $optype1
-  DR2: $optype2
-  DR3: $optype3
-  DR4: $optype4
-  DR5: $optype5
 
-LASI:
-  $lasiStatus
-
-Updated: $tUpdate UTC
-""")
+# Station status, DR OP-TYPE, and LASI status -> display text conversions
+sysStatusText = ('One or more subsystems in error                       ',
+                 'No errors conditions but not all subsystems are normal',
+                 'All subsystems are normal                             ')
+opTypeText = ('Idle        ', 'Spectrometer', 'Recording   ')
+lasiText = ('Not running', 'Running    ')
 
 
 class PollStation(object):
@@ -108,16 +79,36 @@ class PollStation(object):
         self.ndr = ndr
         self.pollInterval = float(pollInterval)
         
-        # Attributes to store the station status
-        self.lastUpdate = datetime.utcnow() - timedelta(minutes=30)
-        self.systemStatus = 0
-        self.opTypes = [0,]*self.ndr
-        self.lasiRunning = False
+        # Station status snapshot of (update time, station status, DR OP-TYPEs, 
+        # LASI running).  This is always replaced as a whole so that it can be
+        # read without a lock.
+        self._snapshot = (datetime.utcnow() - timedelta(minutes=30), 0, [0,]*self.ndr, False)
+        
+        # Validators and parsed values from the last OpScreen status fetch
+        self._etag = None
+        self._lastModified = None
+        self._lastStatus = None
+        
+        # Cache of the last lwatv.png Last-Modified header and its parsed value
+        self._lastLMString = None
+        self._lastLMDateTime = None
         
         # Setup threading
         self.thread = None
-        self.alive = threading.Event()
-        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.first_poll = threading.Event()
+        
+        # Setup a persistent HTTP session so that both status requests reuse 
+        # the same connection to lwalab.  Read errors are retried once in case
+        # the server has closed an idle kept-alive connection between polls.
+        # urllib3 also counts read timeouts as read errors so those are retried
+        # once too.  Connection failures, redirects, and bad statuses are not 
+        # retried.
+        retries = Retry(total=1, connect=0, read=1, redirect=0, status=0, other=0)
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'lwaStatus'
+        self.session.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=4,
+                                                  max_retries=retries))
         
     def start(self):
         if self.thread is not None:
@@ -125,23 +116,47 @@ class PollStation(object):
             
         self.thread = threading.Thread(target=self.monitor, name='monitor')
         self.thread.setDaemon(1)
-        self.alive.set()
+        self.stop_event.clear()
+        self.first_poll.clear()
         self.thread.start()
-        time.sleep(5)
+        
+        # Give the first update a few seconds to finish so that the status is 
+        # ready when we return
+        self.first_poll.wait(5)
         
     def stop(self):
         if self.thread is not None:
-            self.alive.clear()          #clear alive event for thread
+            self.stop_event.set()       #wake the thread and tell it to exit
             
             self.thread.join()          #don't wait too long on the thread to finish
             self.thread = None
             
+        self.session.close()
+        
     def monitor(self):
+        """
+        Poll the station status every pollInterval seconds until stop() is 
+        called.
+        """
+        
+        while True:
+            tStart = time.monotonic()
+            self._poll_once()
+            self.first_poll.set()
+            
+            # Pause before the next monitoring update, waking early if stop() 
+            # is called
+            sleepTime = self.pollInterval - (time.monotonic() - tStart)
+            if self.stop_event.wait(max(0.0, sleepTime)):
+                return
+            
+    def _poll_once(self):
         """
         Get the current state of the LWA station from the OpScreen page.  This 
-        function returns a four element tuple of status update time time as a 
-        datetime instance, the overall station status, a ndr-element list of 
-        DR OP-TYPEs, and a boolean for if LASI is running or not.
+        function updates the status snapshot with a four element tuple of status 
+        update time time as a datetime instance, the overall station status, a 
+        ndr-element list of DR OP-TYPEs, and a boolean for if LASI is running or
+        not.
         
         The station status and OP-TYPEs are expressed a integers.  The values 
         are:
@@ -156,75 +171,75 @@ class PollStation(object):
         2 - Raw data recording mode
         """
         
-        while self.alive.isSet():
-            tStart = time.time()
-            
-            # Update time
-            tNow = datetime.utcnow()
-            
-            # Default values
-            sysStatus = 0
-            opType = [0 for i in range(self.ndr)]
-            lasi = False
+        # Update time
+        tNow = datetime.utcnow()
+        
+        # Default values
+        sysStatus = 0
+        opType = [0]*self.ndr
+        lasi = False
+        
+        try:
+            # Fetch the OpScreen page, only getting the full status if it 
+            # has changed since the last time
+            headers = {}
+            if self._etag is not None:
+                headers['If-None-Match'] = self._etag
+            if self._lastModified is not None:
+                headers['If-Modified-Since'] = self._lastModified
+            r = self.session.get('http://lwalab.phys.unm.edu/OpScreen/%s/status.json' % self.station,
+                                 headers=headers, timeout=30)
             
-            try:
-                # Fetch the OpScreen page
-                with urlopen('http://lwalab.phys.unm.edu/OpScreen/%s/status.json' % self.station) as uh:
-                    output = json.loads(uh.read())
-                    
-                # Parse
+            if r.status_code == 304:
+                ## Unchanged
+                sysStatus, opType = self._lastStatus
+            else:
+                r.raise_for_status()
+                output = json_loads(r.content)
+                
+                ## Parse
                 sysStatus = 2
-                opType = [0 for i in range(self.ndr)]
                 for entry in output:
-                    ## Station status
-                    if entry['setting'] == 'SUMMARY':
-                        if entry['value'] in ('WARNING', 'SHUTDWN') and sysStatus > 1:
-                            sysStatus = 1
-                        if entry['value'] == 'ERROR' and sysStatus > 0:
-                            sysStatus = 0
-                            
-                    ## DR OP-TYPEs
-                    if entry['subsystem'].startswith('DR') and entry['setting'] == 'OP_TYPE':
-                        n = int(entry['subsystem'][2:], 10) - 1
-                        if entry['value'] == 'Record':
-                            opType[n] = 2
-                        elif entry['value'] == 'Spectrometr':
-                            opType[n] = 1
-                            
-                # Figure out if LASI is running
-                with urlopen("http://lwalab.phys.unm.edu/%s/lwatv.png" % self.lwatv_channel) as uh:
-                    info = uh.info()
-                    data = uh.read()
+                    setting = entry['setting']
+                    subsystem = entry['subsystem']
+                    value = entry['value']
                     
-                lm = info.get("last-modified")
-                lm = datetime.strptime(lm, "%a, %d %b %Y %H:%M:%S GMT")
-                age = datetime.utcnow() - lm
-                age = age.days*24*3600 + age.seconds
-                
-                # Is the image recent enough to think that TBN/LASI is running?
-                if age < 120:
-                    lasi = True
-                    
-                # Update
-                self.lock.acquire()
-                self.lastUpdate = tNow
-                self.systemStatus = sysStatus
-                self.opTypes = opType
-                self.lasiRunning = lasi
-                self.lock.release()
-            except Exception as e:
-                pass
+                    ### Station status
+                    if setting == 'SUMMARY':
+                        sysStatus = min(sysStatus, summaryValues.get(value, 2))
+                        
+                    ### DR OP-TYPEs
+                    elif setting == 'OP_TYPE' and subsystem[:2] == 'DR':
+                        n = int(subsystem[2:], 10) - 1
+                        opType[n] = opTypeValues.get(value, 0)
+                        
+                ## Save for next time
+                self._etag = r.headers.get('ETag')
+                self._lastModified = r.headers.get('Last-Modified')
+                self._lastStatus = (sysStatus, opType)
                 
-            # Main loop stop time
-            tStop = time.time()
+            # Figure out if LASI is running - only the headers are needed
+            r = self.session.head("http://lwalab.phys.unm.edu/%s/lwatv.png" % self.lwatv_channel,
+                                  timeout=30, allow_redirects=True)
+            r.raise_for_status()
+            lm = r.headers['Last-Modified']
+            if lm == self._lastLMString:
+                lm = self._lastLMDateTime
+            else:
+                lmDateTime = email.utils.parsedate_to_datetime(lm).replace(tzinfo=None)
+                self._lastLMString, self._lastLMDateTime = lm, lmDateTime
+                lm = lmDateTime
+            age = (datetime.utcnow() - lm).total_seconds()
             
-            # Pause before the next monitoring update
-            sleepCount = 0.0
-            sleepTime = self.pollInterval - (tStop - tStart)
-            while (self.alive.isSet() and sleepCount < sleepTime):
-                time.sleep(0.2)
-                sleepCount += 0.2
+            # Is the image recent enough to think that TBN/LASI is running?
+            if age < 120:
+                lasi = True
                 
+            # Update
+            self._snapshot = (tNow, sysStatus, opType, lasi)
+        except Exception as e:
+            pass
+            
     def getStatus(self):
         """
         Get the current state of LWA1 from the OpScreen page.  This function
@@ -244,11 +259,87 @@ class PollStation(object):
         2 - Raw data recording mode
         """
         
-        self.lock.acquire()
-        output = (self.lastUpdate, self.systemStatus, self.opTypes, self.lasiRunning)
-        self.lock.release()
+        return self._snapshot
+
+
+class BlinkWorker(object):
+    """
+    Class for sending pulses to a BlinkStick from a background thread so that 
+    the main loop is not blocked while a pulse is running.  Each pulse is 
+    followed by a 0.25 s dark gap and only one pulse is handled at a time.  Any
+    error other than an IOError stops the worker and is saved to the error 
+    attribute.
+    """
+    
+    def __init__(self, bs):
+        self.bs = bs
+        self.error = None
+        
+        # Setup threading
+        self.thread = None
+        self.queue = queue.Queue(maxsize=1)
+        self.idle = threading.Event()
+        self.idle.set()
+        
+    def start(self):
+        if self.thread is not None:
+            self.stop()
+            
+        self.thread = threading.Thread(target=self.run, name='blink')
+        self.thread.daemon = True
+        self.error = None
+        self.idle.set()
+        self.thread.start()
+        
+    def stop(self):
+        if self.thread is not None:
+            # Drop anything that is still waiting and tell the thread to exit
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(None)
+            
+            self.thread.join(timeout=5) #don't wait too long on the thread to finish
+            self.thread = None
+            
+    def run(self):
+        """
+        Pulse the BlinkStick for each (color name, duration in ms) item in the 
+        queue until None is received.
+        """
+        
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+                
+            name, duration = item
+            try:
+                self.bs.pulse(name=name, repeats=1, duration=duration)
+            except IOError:
+                pass
+            except Exception as e:
+                self.error = e
+                break
+                
+            time.sleep(0.25)
+            self.idle.set()
+            
+    def pulse(self, name, duration):
+        """
+        Queue a pulse of the specified color name and duration in ms.  Returns 
+        True if the pulse was queued, False if the worker is still busy with 
+        the previous one.
+        """
         
-        return output
+        if not self.idle.is_set():
+            return False
+            
+        self.idle.clear()
+        self.queue.put_nowait((name, duration))
+        return True
 
 
 def restorescreen():
@@ -268,31 +359,46 @@ def getDisplayInformation(tNow, stationName, sysStatus, opType, lasi):
     
     # Station status
     subs = {'station': stationName.upper()}
-    if sysStatus == 0:
-        subs['sysStatus'] = 'One or more subsystems in error                       '
-    elif sysStatus == 1:
-        subs['sysStatus'] = 'No errors conditions but not all subsystems are normal'
-    else:
-        subs['sysStatus'] = 'All subsystems are normal                             '
-        
+    subs['sysStatus'] = sysStatusText[sysStatus]
+    
     # DR OP-TYPEs
-    for i in range(len(opType)):
-        key = 'optype%i' % (i+1)
-        if opType[i] == 0:
-            subs[key] = 'Idle        '
-        elif opType[i] == 1:
-            subs[key] = 'Spectrometer'
-        else:
-            subs[key] = 'Recording   '
-            
+    for i,ot in enumerate(opType):
+        subs['optype%i' % (i+1)] = opTypeText[ot]
+        
     # LASI status
-    subs['lasiStatus'] = 'Running    ' if lasi else 'Not running'
+    subs['lasiStatus'] = lasiText[bool(lasi)]
     
     # Update time
     subs['tUpdate'] = tNow.strftime("%Y/%m/%d %H:%M:%S")
     
     # Done
-    return display[len(opType)].safe_substitute(subs)
+    return display[len(opType)].format_map(subs)
+
+
+def updateScreen(screen, info, lastLines):
+    """
+    Given a curses screen, the output of getDisplayInformation(), and the list
+    of lines currently on the screen, redraw only the lines that have changed.
+    Returns the new list of lines on the screen.
+    """
+    
+    lines = info.split('\n')
+    for i,line in enumerate(lines):
+        if i < len(lastLines) and line == lastLines[i]:
+            continue
+        screen.move(i,0)
+        screen.clrtoeol()
+        screen.addstr(i,0,line)
+        
+    # Clear out anything left over from a longer display
+    for i in range(len(lines), len(lastLines)):
+        screen.move(i,0)
+        screen.clrtoeol()
+        
+    screen.noutrefresh()
+    curses.doupdate()
+    
+    return lines
 
 
 def main(args):
@@ -313,6 +419,8 @@ def main(args):
     # Setup the BlinkStick
     bs = blinkstick.find_first()
     print(f"Using: {bs.get_serial()}")
+    blink = BlinkWorker(bs)
+    blink.start()
     
     # Integer -> LED color conversion list
     ssColors = ['red', 'orange', 'green']
@@ -328,66 +436,57 @@ def main(args):
         screen = curses.initscr()
         curses.noecho()
         curses.cbreak()
-        screen.nodelay(1)
+        curses.halfdelay(1)
         
         # Get the latest information from the OpScreen page
-        t0 = time.time()
+        t0 = time.monotonic()
         tNow, sysStatus, opType, lasi = poll.getStatus()
         
         # Refresh screen
-        screen.clear()
-        screen.addstr(0,0,getDisplayInformation(tNow, station, sysStatus, opType, lasi))
-        screen.refresh()
+        lastLines = updateScreen(screen, getDisplayInformation(tNow, station, sysStatus, opType, lasi), [])
+        
+        # Blink sequence state
+        blinkSequence = []
+        blinkStep = 0
         
         # Go!
         while True:
             ## Check the time to see if we need to update the status.  This happens
             ## once every ~3 minutes to keep the load on lwalab down.
-            t1 = time.time()
+            t1 = time.monotonic()
             if t1-t0 > 30:
                 # Update
-                t0 = time.time()
+                t0 = t1
                 tNow, sysStatus, opType, lasi = poll.getStatus()
                 
                 # Refresh screen
-                screen.clear()
-                screen.addstr(0,0,getDisplayInformation(tNow, station, sysStatus, opType, lasi))
+                lastLines = updateScreen(screen, getDisplayInformation(tNow, station, sysStatus, opType, lasi), lastLines)
                 
-            ## Blink out the station status
-            try:
-                bs.pulse(name=ssColors[sysStatus], repeats=1, duration=1000)
-                time.sleep(0.25)
-            except IOError:
-                pass
-                
-            ## Blink out the DR OP-TYPEs as needed
-            for ot in opType:
-                # Skip Idle DRs
-                if ot == 0:
-                    continue
-                    
-                # Blink
-                try:
-                    bs.pulse(name=otColors[ot], repeats=1, duration=250)
-                    time.sleep(0.25)
-                except IOError:
-                    pass
-                    
-            # Blink the LASI status
-            if lasi:
-                try:
-                    bs.pulse(name='purple', repeats=1, duration=250)
-                    time.sleep(0.25)
-                except IOError:
-                    pass
+            ## Blink out the next step of the sequence once the previous one
+            ## has finished.  Each sequence is the station status followed by
+            ## the non-idle DR OP-TYPEs and then the LASI status.
+            if blink.error is not None:
+                raise blink.error
+            if blink.idle.is_set():
+                if blinkStep >= len(blinkSequence):
+                    blinkSequence = [(ssColors[sysStatus], 1000),]
+                    blinkSequence.extend([(otColors[ot], 250) for ot in opType if ot != 0])
+                    if lasi:
+                        blinkSequence.append(('purple', 250))
+                    blinkStep = 0
                     
-            ## Check for keypress and exit if Q or q
-            c = screen.getch()
-            if (c > 0):
-                if chr(c) == 'q': 
-                    break
-                if chr(c) == 'Q': 
+                name, duration = blinkSequence[blinkStep]
+                if blink.pulse(name, duration):
+                    blinkStep += 1
+                
+            ## Check for keypress and exit if Q or q.  This waits for up to 
+            ## 100 ms for input which also sets the pace of the loop.
+            try:
+                if screen.getkey() in ('q', 'Q'):
                     break
+            except curses.error:
+                ## No keypress
+                pass
                     
     except KeyboardInterrupt:
         pass        
@@ -396,18 +495,14 @@ def main(args):
         exitException = str(e)
         
     # Save the window contents
-    contents = ''
     y,x = screen.getmaxyx()
-    for i in range(y-1):
-        for j in range(x):
-            d = screen.inch(i,j)
-            c = d&0xFF
-            a = (d>>8)&0xFF
-            contents += chr(c)
-            
+    lines = [screen.instr(i,0,x).rstrip() for i in range(y-1)]
+    contents = b'\n'.join(lines).decode('latin-1')
+    
     # Finished with the poll-update loop.  Reset the screen and turn off 
     # the blinkstick
     restorescreen()
+    blink.stop()
     bs.turn_off()
     poll.stop()
     